@@ -3,7 +3,15 @@ import pika  # communication via RabbitMQ
 import os  # used to access environmental variables
 import time  # Used to sleep if necessary
 import io  # Used for the writing of streams to String objects
+import hashlib  # Used to fingerprint the training data
+import shutil  # Used to remove cached models
+import tempfile  # Used to write cache entries before they become visible
+import socket  # Used to get the host name as default replica ID
+import functools  # Used to hand over messages and acknowledgements to the IO loop thread
+import numpy as np
 import pandas as pd
+from scipy.spatial import cKDTree  # Spatial index for the nearest neighbour search
+from rdflib import Graph, URIRef  # Used to access the RDF meta data of the system instance
 from threading import Thread, Semaphore  # Threads and their synchronization
 
 # Set up logging
@@ -12,6 +20,8 @@ logger = logging.getLogger(__name__)
 
 # Define the predefined command ID for SYSTEM_READY_SIGNAL
 SYSTEM_READY_SIGNAL = 1
+# Define the predefined command ID for START_BENCHMARK
+START_BENCHMARK_SIGNAL = 17
 # Define the predefined command ID for TASK_GENERATION_FINISHED
 TASK_GENERATION_FINISHED_SIGNAL = 15
 # Define the predefined command ID for REPORT_ERROR
@@ -20,9 +30,144 @@ REPORT_ERROR_SIGNAL = 19
 MAX_CONNECTION_ATTEMPTS = 5
 # Time that the program waits between two connection attempts
 SECONDS_BETWEEN_CONNECTION_ATTEMPTS = 5
+# The number of communication parts (command, train data, broadcast train data, tasks, answers) that have to be set up
+COMMUNICATION_SETUP_STEPS = 5
 # constants needed to communicate with the benchmark
 LEARNING_FINISHED_SIGNAL = 101
+# Announces a replica (with its ID) to the benchmark, which waits for all replicas before sending the training data
+REPLICA_READY_SIGNAL = 102
 MESSAGE_CSV_SEPARATOR = ';'
+SYSTEM_NAMESPACE = "http://example.org/ai-winter-school-2024/system/"
+# The models that the system can use
+MEAN_MODEL = SYSTEM_NAMESPACE + "MeanModel"
+KNN_MODEL = SYSTEM_NAMESPACE + "KnnModel"
+# The default number of neighbours that the k-NN model takes into account
+DEFAULT_K = 5
+# Default upper bound of the disk space that the model cache may use (1 GiB)
+DEFAULT_MODEL_CACHE_MAX_BYTES = 1 << 30
+
+
+class ModelCache:
+    """
+    A small on-disk cache for trained models. Every entry is a directory named after the fingerprint of the training
+    data that contains one .npy file per model parameter. The parameters are loaded as memory-mapped arrays. If the
+    cache grows beyond its size limit, the least recently used entries are removed.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_MODEL_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.logger = logging.getLogger(__name__)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def fingerprint(data: str, salt: str = "") -> str:
+        """
+        Determine the fingerprint of the given training data.
+
+        Args:
+            data (str): The training data as CSV
+            salt (str): Additional information (e.g., the model configuration) that influences the trained model
+
+        Returns:
+            str: The hex digest that identifies the training data
+        """
+        digest = hashlib.sha256()
+        digest.update(salt.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(data.encode("utf-8"))
+        return digest.hexdigest()
+
+    def load(self, key: str):
+        """
+        Load the parameters of a cached model.
+
+        Args:
+            key (str): The fingerprint of the training data
+
+        Returns:
+            dict: The model parameters as memory-mapped arrays or None if there is no such entry
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(entry_dir):
+            return None
+        try:
+            parameters = {}
+            for file_name in os.listdir(entry_dir):
+                if file_name.endswith(".npy"):
+                    parameters[file_name[:-4]] = np.load(os.path.join(entry_dir, file_name), mmap_mode='r')
+            # Mark the entry as recently used
+            os.utime(entry_dir)
+            return parameters
+        except Exception as e:
+            self.logger.warning(f"Couldn't load cached model {key}. Ignoring it: {e}")
+            return None
+
+    def store(self, key: str, parameters: dict):
+        """
+        Store the parameters of a trained model and evict old entries if the cache exceeds its size limit.
+
+        Args:
+            key (str): The fingerprint of the training data
+            parameters (dict): The model parameters as a mapping from names to NumPy arrays
+
+        Returns:
+            None
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        # Write into a temporary directory first, so that a crash never leaves a half-written entry behind
+        tmp_dir = None
+        try:
+            # Every writer needs its own directory, since several replicas may store the same model at the same time
+            tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix=key + ".tmp")
+            for name, values in parameters.items():
+                np.save(os.path.join(tmp_dir, name + ".npy"), np.ascontiguousarray(values))
+            os.rename(tmp_dir, entry_dir)
+        except OSError as e:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if os.path.isdir(entry_dir):
+                # Another replica has stored the same model in the meantime
+                self.logger.info(f"Model {key} has already been stored by another process.")
+            else:
+                self.logger.warning(f"Couldn't store model {key} in the cache: {e}")
+            return
+        except Exception as e:
+            self.logger.warning(f"Couldn't store model {key} in the cache: {e}")
+            if tmp_dir is not None:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        self.evict()
+
+    def remove(self, key: str):
+        """
+        Remove the given entry (e.g., because it is incomplete), so that it can be stored again.
+        """
+        shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits into its size limit.
+        """
+        entries = []
+        total_size = 0
+        for key in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, key)
+            if not os.path.isdir(entry_dir) or ".tmp" in key:
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+                entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+            except FileNotFoundError:
+                # Another replica sharing the cache evicted this entry in the meantime
+                continue
+            total_size += size
+        entries.sort()
+        # Always keep the most recently used entry
+        while total_size > self.max_bytes and len(entries) > 1:
+            _, size, entry_dir = entries.pop(0)
+            self.logger.info(f"Evicting cached model {entry_dir}...")
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
 
 
 class AIWinterSchoolBaselineSystem:
@@ -37,8 +182,17 @@ class AIWinterSchoolBaselineSystem:
             "train_queue_name": "hobbit.datagen-system." + self.session_id,
             "task_queue_name": "hobbit.taskgen-system." + self.session_id,
             "answer_queue_name": "hobbit.system-evalstore." + self.session_id,
+            # If several replicas of the system share the task queue, the training data is broadcast via this exchange
+            "train_exchange_name": "hobbit.datagen-system-broadcast." + self.session_id,
+            # The ID of this replica is added to every answer
+            "replica_id": os.getenv("SYSTEM_REPLICA_ID", socket.gethostname()),
+            # The number of tasks this replica may receive before it has answered them
+            "prefetch_count": int(os.getenv("SYSTEM_PREFETCH_COUNT", "1")),
             #    "command_queue_name": "hobbit.command_queue" + os.getenv("HOBBIT_SESSION_ID", ""),
-            "system_model": os.getenv("SYSTEM_PARAMETERS_MODEL", "")
+            "system_model": os.getenv("SYSTEM_PARAMETERS_MODEL", ""),
+            "model_cache_dir": os.getenv("SYSTEM_MODEL_CACHE_DIR", ""),
+            "model_cache_max_bytes": int(os.getenv("SYSTEM_MODEL_CACHE_MAX_BYTES",
+                                                   str(DEFAULT_MODEL_CACHE_MAX_BYTES)))
         }
         self.connection = None
         self.communication_mutex = Semaphore(value=0)
@@ -49,9 +203,46 @@ class AIWinterSchoolBaselineSystem:
         self.sender_channel = None
         self.logger = logging.getLogger(__name__)
         self.io_thread = None
+        # The model cache is only used if a cache directory has been configured
+        self.model_cache = None
+        if len(self.config["model_cache_dir"]) > 0:
+            self.model_cache = ModelCache(self.config["model_cache_dir"], self.config["model_cache_max_bytes"])
+
+        # Parse the parameter model and get parameter values
+        self.model = MEAN_MODEL
+        self.k = DEFAULT_K
+        self.parse_system_parameters()
 
         # Here, you can add more things that you may need for your prediction
         self.baseline_prediction = 0.0
+        # Parameters of the k-NN model
+        self.feature_means = None
+        self.feature_scales = None
+        self.train_features = None
+        self.train_targets = None
+        self.tree = None
+
+    def parse_system_parameters(self):
+        """
+        Parse the parameter model of the system instance. Parameters that are not set keep their default values.
+        """
+        if len(self.config["system_model"]) == 0:
+            return
+        parameters_graph = Graph()
+        parameters_graph.parse(data=self.config["system_model"], format="json-ld")
+        model_iri = next(parameters_graph.objects(predicate=URIRef(SYSTEM_NAMESPACE + "model")), None)
+        if model_iri is not None:
+            if str(model_iri) not in (MEAN_MODEL, KNN_MODEL):
+                self.logger.error(f"Unknown model IRI {model_iri}.")
+                raise AttributeError()
+            self.model = str(model_iri)
+        k_str = next(parameters_graph.objects(predicate=URIRef(SYSTEM_NAMESPACE + "k")), None)
+        if k_str is not None:
+            self.k = int(k_str)
+            if self.k < 1:
+                self.logger.error(f"The number of neighbours has to be positive but is {self.k}.")
+                raise AttributeError()
+        self.logger.info(f"Using model {self.model} (k={self.k}).")
 
     def process_train_data(self, data):
         """
@@ -64,13 +255,109 @@ class AIWinterSchoolBaselineSystem:
         Returns:
             None
         """
+        # If we have seen the same training data before, we can reuse the model that we trained back then
+        cache_key = None
+        if self.model_cache is not None:
+            cache_key = ModelCache.fingerprint(data, salt=f"{self.model};{self.k}")
+            parameters = self.model_cache.load(cache_key)
+            if parameters is not None:
+                self.logger.info(f"Found trained model {cache_key} in the cache.")
+                try:
+                    self.set_model_parameters(parameters)
+                    self.send_command(LEARNING_FINISHED_SIGNAL, self.config["replica_id"])
+                    return
+                except Exception as e:
+                    # The entry may be incomplete, e.g., because another replica evicted it while we were loading it
+                    self.logger.warning(f"Couldn't use cached model {cache_key}. Training a new one: {e}")
+                    self.model_cache.remove(cache_key)
+
         train_data = pd.read_csv(io.StringIO(data), sep=MESSAGE_CSV_SEPARATOR)
-        # Here, we could implement a lot of fancy machine learning. This baseline simply determines the mean value that
-        # it should predict.
-        self.baseline_prediction = train_data[train_data.columns[len(train_data.columns) - 1]].mean()
+        if self.model == KNN_MODEL:
+            # The first column contains the row ID and the last column the quality; everything in between are features
+            self.train_knn(train_data.iloc[:, 1:-1].to_numpy(dtype=np.float64),
+                           train_data.iloc[:, -1].to_numpy(dtype=np.float64))
+        else:
+            # Here, we could implement a lot of fancy machine learning. This baseline simply determines the mean value
+            # that it should predict.
+            self.baseline_prediction = train_data[train_data.columns[len(train_data.columns) - 1]].mean()
 
         # Learning finished. Let's tell the Benchmark that we are ready to go
-        self.send_command(LEARNING_FINISHED_SIGNAL)
+        self.send_command(LEARNING_FINISHED_SIGNAL, self.config["replica_id"])
+
+        if cache_key is not None:
+            self.model_cache.store(cache_key, self.get_model_parameters())
+
+    def get_model_parameters(self):
+        """
+        Get the parameters of the trained model, e.g., to store them in the model cache.
+
+        Returns:
+            dict: The model parameters as a mapping from names to NumPy arrays
+        """
+        if self.model == KNN_MODEL:
+            return {"feature_means": self.feature_means,
+                    "feature_scales": self.feature_scales,
+                    "train_features": self.train_features,
+                    "train_targets": self.train_targets}
+        return {"baseline_prediction": np.array([self.baseline_prediction], dtype=np.float64)}
+
+    def set_model_parameters(self, parameters):
+        """
+        Replace the internal model with the given parameters, e.g., loaded from the model cache.
+
+        Args:
+            parameters (dict): The model parameters as a mapping from names to NumPy arrays
+
+        Returns:
+            None
+        """
+        if self.model == KNN_MODEL:
+            self.feature_means = parameters["feature_means"]
+            self.feature_scales = parameters["feature_scales"]
+            self.train_features = parameters["train_features"]
+            self.train_targets = parameters["train_targets"]
+            # The index itself is not cached. Rebuilding it is cheap compared to parsing the training data.
+            self.tree = cKDTree(self.train_features)
+        else:
+            self.baseline_prediction = float(parameters["baseline_prediction"][0])
+
+    def train_knn(self, features, targets):
+        """
+        Standardize the training features and build a KD-tree over them.
+
+        Args:
+            features (np.ndarray): The training features (one row per wine)
+            targets (np.ndarray): The quality of the single wines
+
+        Returns:
+            None
+        """
+        self.feature_means = features.mean(axis=0)
+        self.feature_scales = features.std(axis=0)
+        # Constant features would lead to a division by zero
+        self.feature_scales[self.feature_scales == 0] = 1.0
+        self.train_features = (features - self.feature_means) / self.feature_scales
+        self.train_targets = targets
+        self.tree = cKDTree(self.train_features)
+
+    def predict(self, features):
+        """
+        Predict the quality of one or more wines.
+
+        Args:
+            features (np.ndarray): The features of the wines (one row per wine)
+
+        Returns:
+            np.ndarray: The predicted quality of the single wines
+        """
+        if self.model != KNN_MODEL:
+            return np.full(len(features), self.baseline_prediction)
+        k = min(self.k, len(self.train_targets))
+        features = (features - self.feature_means) / self.feature_scales
+        _, neighbours = self.tree.query(features, k=k)
+        # For k=1, the index returns a flat array
+        neighbours = neighbours.reshape(len(features), k)
+        return self.train_targets[neighbours].mean(axis=1)
 
     def process_task(self, task):
         """
@@ -84,18 +371,22 @@ class AIWinterSchoolBaselineSystem:
         """
         try:
             task_data = pd.read_csv(io.StringIO(task), sep=MESSAGE_CSV_SEPARATOR)
-            # The first cell contains the task ID (you may want to remove it before using the data!)
-            task_id = task_data.iloc[0, 0]
-            # Here, we can go crazy with the previous learned model. In this baseline, we simply send the result that
-            # we already prepared
-            answer = self.baseline_prediction
-
-            # Send the answer to the evaluation store
-            answer_message = f"{task_id}{MESSAGE_CSV_SEPARATOR}{answer}"
-            self.sender_channel.basic_publish(exchange='',
-                                              routing_key=self.config["answer_queue_name"],
-                                              body=answer_message
-                                              )
+            # The first column contains the task IDs (you may want to remove it before using the data!). A task may
+            # comprise several lines, which are predicted as one batch.
+            task_ids = task_data.iloc[:, 0].to_numpy()
+            # The features are the columns following the ID (the task may still contain the quality as last column)
+            num_features = len(self.feature_means) if self.model == KNN_MODEL else 0
+            features = task_data.iloc[:, 1:1 + num_features].to_numpy(dtype=np.float64)
+            answers = self.predict(features)
+
+            # Send the answers to the evaluation store (together with our replica ID)
+            for task_id, answer in zip(task_ids, answers):
+                answer_message = (f"{task_id}{MESSAGE_CSV_SEPARATOR}{answer}"
+                                  f"{MESSAGE_CSV_SEPARATOR}{self.config['replica_id']}")
+                # Channels are not thread safe. Hence, the IO loop thread has to send the answer.
+                self.connection.ioloop.add_callback_threadsafe(
+                    functools.partial(self.sender_channel.basic_publish, exchange='',
+                                      routing_key=self.config["answer_queue_name"], body=answer_message))
 
         except Exception as e:
             logging.exception(f"Error processing task: {e}")
@@ -137,11 +428,9 @@ class AIWinterSchoolBaselineSystem:
             else:
                 self.logger.exception(exception)
                 self.connection = None
-                # release four times for all four communication types
-                self.communication_mutex.release()
-                self.communication_mutex.release()
-                self.communication_mutex.release()
-                self.communication_mutex.release()
+                # release the mutex for all communication types
+                for x in range(COMMUNICATION_SETUP_STEPS):
+                    self.communication_mutex.release()
 
         self.logger.info("Trying to connect to " + self.config["rabbitmq_host"] + "...")
         self.connection_attempt_counts += 1
@@ -175,6 +464,16 @@ class AIWinterSchoolBaselineSystem:
             self.receiver_channel.queue_declare(queue=self.config["train_queue_name"], auto_delete=True,
                                                 callback=rec_train_call_back)
 
+            def rec_train_broadcast_call_back(frame):
+                self.declare_train_data_broadcast_handler(frame.method.queue)
+
+            def rec_train_exchange_call_back(frame):
+                # Every replica gets its own queue, so that all of them receive the training data
+                self.receiver_channel.queue_declare(queue='', exclusive=True, callback=rec_train_broadcast_call_back)
+
+            self.receiver_channel.exchange_declare(exchange=self.config["train_exchange_name"], exchange_type='fanout',
+                                                   auto_delete=True, callback=rec_train_exchange_call_back)
+
             def rec_test_call_back(frame):
                 self.declare_test_data_handler()
 
@@ -218,7 +517,10 @@ class AIWinterSchoolBaselineSystem:
                     return
 
                 command_id = int.from_bytes(body[id_end_pos:id_end_pos + 1], byteorder='big', signed=False)
-                if command_id == TASK_GENERATION_FINISHED_SIGNAL:
+                if command_id == START_BENCHMARK_SIGNAL:
+                    # Announce ourselves again; the benchmark may not have listened when we were ready
+                    self.send_command(REPLICA_READY_SIGNAL, self.config["replica_id"])
+                elif command_id == TASK_GENERATION_FINISHED_SIGNAL:
                     self.logger.info(f"Received TASK_GENERATION_FINISHED command for session: {session_id}")
                     # We are done
                     self.termination_mutex.release()
@@ -234,29 +536,50 @@ class AIWinterSchoolBaselineSystem:
         logger.info("Command queue communication is set up.")
         self.communication_mutex.release()
 
-    def declare_train_data_handler(self):
+    def handle_train_data(self, ch, method, header, body):
         # Define handler for incoming data
-        def handle_data(ch, method, header, body):
-            self.logger.info("Received data...")
-            str_data = body.decode("utf-8")
-            thread = Thread(target=self.process_train_data, args=[str_data])
-            thread.start()  # TODO this is quite costly. We should use a thread pool instead
+        self.logger.info("Received data...")
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        str_data = body.decode("utf-8")
+        thread = Thread(target=self.process_train_data, args=[str_data])
+        thread.start()  # TODO this is quite costly. We should use a thread pool instead
 
-        self.receiver_channel.basic_consume(self.config["train_queue_name"], handle_data)
+    def declare_train_data_handler(self):
+        self.receiver_channel.basic_consume(self.config["train_queue_name"], self.handle_train_data)
         logger.info("Data receiving communication is set up.")
         self.communication_mutex.release()
 
+    def declare_train_data_broadcast_handler(self, broadcast_queue_name):
+        # We are only ready once the queue is bound. Otherwise, we could miss the training data.
+        def bind_call_back(frame):
+            self.receiver_channel.basic_consume(broadcast_queue_name, self.handle_train_data)
+            logger.info("Broadcast data receiving communication is set up.")
+            self.communication_mutex.release()
+
+        self.receiver_channel.queue_bind(exchange=self.config["train_exchange_name"], queue=broadcast_queue_name,
+                                         callback=bind_call_back)
+
     def declare_test_data_handler(self):
         # Define handler for incoming data
         def handle_data(ch, method, header, body):
             self.logger.info("Received data...")
             str_data = body.decode("utf-8")
-            thread = Thread(target=self.process_task, args=[str_data])
+            thread = Thread(target=self.process_task_and_ack, args=[str_data, ch, method.delivery_tag])
             thread.start()  # TODO this is quite costly. We should use a thread pool instead
 
-        self.receiver_channel.basic_consume(self.config["task_queue_name"], handle_data)
-        logger.info("Data receiving communication is set up.")
-        self.communication_mutex.release()
+        # Replicas sharing the task queue get only as many tasks as they are allowed to work on at the same time.
+        # Since the tasks are acknowledged after they have been answered, they are distributed fairly.
+        def qos_call_back(frame):
+            self.receiver_channel.basic_consume(self.config["task_queue_name"], handle_data)
+            logger.info("Data receiving communication is set up.")
+            self.communication_mutex.release()
+
+        self.receiver_channel.basic_qos(prefetch_count=self.config["prefetch_count"], callback=qos_call_back)
+
+    def process_task_and_ack(self, task, channel, delivery_tag):
+        self.process_task(task)
+        # Channels are not thread safe. Hence, the IO loop thread has to send the acknowledgement.
+        self.connection.ioloop.add_callback_threadsafe(functools.partial(channel.basic_ack, delivery_tag=delivery_tag))
 
     def declare_data_sender(self):
         logger.info("Data sending communication is set up.")
@@ -289,8 +612,11 @@ class AIWinterSchoolBaselineSystem:
             if (data is not None) and (len(data) > 0):
                 content += bytes(data.encode('utf-8'))
 
-            # Publish the message to the specified exchange
-            self.cmd_channel.basic_publish(exchange='hobbit.command', routing_key='', body=content)
+            # Publish the message to the specified exchange. Channels are not thread safe. Hence, the IO loop thread
+            # has to send the message.
+            self.connection.ioloop.add_callback_threadsafe(
+                functools.partial(self.cmd_channel.basic_publish, exchange='hobbit.command', routing_key='',
+                                  body=content))
             self.logger.info(f"Sent {content}")
         except Exception as e:
             self.logger.exception(f"Error sending command: {e}")
@@ -309,8 +635,8 @@ class AIWinterSchoolBaselineSystem:
             # 1. setup communication
             self.setup_connection()
             self.logger.info("Main thread waiting for the connection to be up...")
-            # We have to acquire the lock 3 times
-            for x in range(4):
+            # We have to acquire the lock once for every part of the communication
+            for x in range(COMMUNICATION_SETUP_STEPS):
                 # Wait for 120 seconds
                 if not self.communication_mutex.acquire(timeout=120):
                     raise Exception("Couldn't establish communication within 120 seconds. Aborting.")
@@ -321,6 +647,7 @@ class AIWinterSchoolBaselineSystem:
             # Send a signal that the system is ready to consume data
             self.logger.info("Setup done. Sending ready signal...")
             self.send_command(SYSTEM_READY_SIGNAL)
+            self.send_command(REPLICA_READY_SIGNAL, self.config["replica_id"])
 
             # 4. We are waiting for the message on the command queue that will stop the loop
             self.termination_mutex.acquire()
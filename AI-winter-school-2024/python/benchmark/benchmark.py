@@ -2,14 +2,18 @@ import sys
 import logging
 import os
 import signal
+import json
 import pika
 import pandas as pd
 import time
 from rdflib import Graph, URIRef  # Used to access the RDF meta data of the system instance
-from threading import Thread
+from threading import Thread, Lock, Condition
+from concurrent.futures import ProcessPoolExecutor  # Used to encode the tasks in parallel
 import numpy as np
 import io
 import math
+import functools
+import multiprocessing
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -22,6 +26,8 @@ BENCHMARK_FINISHED_SIGNAL = 11
 TASK_GENERATION_FINISHED_SIGNAL = 15
 START_BENCHMARK_SIGNAL = 17
 LEARNING_FINISHED_SIGNAL = 101
+# Sent by every system replica (with its ID) as soon as it can receive the training data
+REPLICA_READY_SIGNAL = 102
 
 MAX_CONNECTION_ATTEMPTS = 5
 SECONDS_BETWEEN_CONNECTION_ATTEMPTS = 5
@@ -32,6 +38,62 @@ DATA_FOLDER_PATH = '/data/'
 FILE_CSV_SEPARATOR = ';'
 MESSAGE_CSV_SEPARATOR = ';'
 TRAIN_DATA_AMOUNT = 0.9
+# It seems like we shouldn't quit too fast after sending the result. Otherwise, the platform may think that the
+# benchmark crashed.
+RESULT_GRACE_PERIOD_SECONDS = 20
+
+# The number of tasks that are encoded together by one worker process
+TASK_SHARD_SIZE = 10000
+
+# Capacity search: the relative precision of the bisection, the maximum number of load steps, the time that we
+# wait at least for the answers of a load step before giving up and the maximum delay of the sending (relative to the
+# latency SLO) up to which a load step is valid
+CAPACITY_SEARCH_PRECISION = 0.05
+CAPACITY_SEARCH_MAX_STEPS = 30
+CAPACITY_SEARCH_DRAIN_TIMEOUT_SECONDS = 60.0
+CAPACITY_SEARCH_MAX_SENDER_LAG = 0.1
+
+# Phases of the test; only the steady state is used for the main runtime KPIs
+WARMUP_PHASE = "warmup"
+STEADY_STATE_PHASE = "steady"
+COOLDOWN_PHASE = "cooldown"
+
+# Datasets that have already been loaded (file name -> DataFrame), so that a sweep reads every file only once
+loaded_datasets = {}
+loaded_datasets_lock = Lock()
+
+
+def encode_task_shard(shard):
+    """
+    Encode the tasks of the given shard of the test data as CSV messages. Every message comprises the header line and
+    the line of a single task. This is executed by the worker processes.
+
+    Args:
+        shard (pd.DataFrame): A part of the test data; its index contains the task IDs
+
+    Returns:
+        list: The messages of the single tasks in the order of the shard
+    """
+    header = shard.iloc[0:0].to_csv(sep=MESSAGE_CSV_SEPARATOR, header=True)
+    lines = shard.to_csv(sep=MESSAGE_CSV_SEPARATOR, header=False).splitlines(keepends=True)
+    return [header + line for line in lines]
+
+
+def load_dataset(data_file: str):
+    """
+    Load the given dataset file or return it from memory if it has been loaded before.
+
+    Args:
+        data_file (str): The path of the CSV file
+
+    Returns:
+        pd.DataFrame: The complete dataset. It must not be changed by the caller.
+    """
+    with loaded_datasets_lock:
+        if data_file not in loaded_datasets:
+            logger.info(f"Loading {data_file}...")
+            loaded_datasets[data_file] = pd.read_csv(data_file, sep=FILE_CSV_SEPARATOR)
+        return loaded_datasets[data_file]
 
 
 class BenchmarkResult:
@@ -44,20 +106,89 @@ class BenchmarkResult:
 
 class AIWinterSchoolBenchmark:
 
-    def __init__(self):
-        self.session_id = os.getenv("HOBBIT_SESSION_ID")
+    def __init__(self, session_id: str = None, experiment_uri: str = None, dataset_iri: str = None, seed: int = None):
+        """
+        Create the benchmark. By default, the session, experiment and parameters are taken from the environment
+        variables set by the platform. A sweep passes them explicitly instead.
+        """
+        self.session_id = session_id if session_id is not None else os.getenv("HOBBIT_SESSION_ID")
         self.config = {
             "rabbitmq_host": os.getenv("HOBBIT_RABBIT_HOST", "127.0.0.1"),
-            "session_id": os.getenv("HOBBIT_SESSION_ID", ""),
-            "experiment_uri": os.getenv("HOBBIT_EXPERIMENT_URI", ""),
+            "session_id": self.session_id,
+            "experiment_uri": experiment_uri if experiment_uri is not None else os.getenv("HOBBIT_EXPERIMENT_URI", ""),
             "benchmark_parameter_model": os.getenv("BENCHMARK_PARAMETERS_MODEL", ""),
             #    "rabbitmq_user": os.getenv("RABBITMQ_DEFAULT_USER", "guest"),
             #    "rabbitmq_pass": os.getenv("RABBITMQ_DEFAULT_PASS", "guest"),
             "train_queue_name": "hobbit.datagen-system." + self.session_id,
             "task_queue_name": "hobbit.taskgen-system." + self.session_id,
             "answer_queue_name": "hobbit.system-evalstore." + self.session_id,
+            # If several replicas of the system share the task queue, the training data is broadcast via this exchange
+            "train_exchange_name": "hobbit.datagen-system-broadcast." + self.session_id,
         }
-        # Parse the parameter model and get parameter values
+        # The number of system replicas that compete for the tasks and the number of tasks that are sent before
+        # waiting for answers (None means one task per replica)
+        self.system_replicas = 1
+        self.tasks_in_flight = None
+        # The time that replicas have to get ready (after the start signal) and to finish learning
+        self.replica_timeout_seconds = 600.0
+        # The first tasks (by number or by the time since the first task has been sent) and the last tasks are sent
+        # as usual but are excluded from the steady-state KPIs
+        self.warmup_tasks = 0
+        self.warmup_seconds = 0.0
+        self.cooldown_tasks = 0
+        # If a latency SLO (in ms) is given, the benchmark searches the highest rate (tasks per second) at which the
+        # given percentile of the latencies stays below the SLO instead of sending every task once
+        self.latency_slo = None
+        self.latency_slo_percentile = 99.0
+        self.capacity_step_seconds = 10.0
+        self.capacity_start_rate = 10.0
+        if dataset_iri is not None and seed is not None:
+            self.dataset_iri = URIRef(dataset_iri)
+            self.seed = int(seed)
+        else:
+            self.parse_parameters()
+
+        self.connection = None
+        self.connection_attempt_counts = 0
+        self.channel = None
+        self.command_queue_name = None
+        self.next_task_id = 0
+        self.system_id = None
+        self.test_data = None
+        self.train_data = None
+        self.timestamps_sent = {}
+        self.timestamps_received = {}
+        self.answers = {}
+        # The encoded task messages (in the order of the task IDs). They are filled by the materializer thread.
+        self.task_messages = []
+        self.task_messages_condition = Condition()
+        self.task_materialization_failed = False
+        self.answers_received = 0
+        # Scheduled, published and receive time stamps of the capacity search (the task IDs continue across the load
+        # steps)
+        self.capacity_search_running = False
+        self.capacity_timestamps_sent = {}
+        self.capacity_timestamps_published = {}
+        self.capacity_timestamps_received = {}
+        self.capacity_steps = []
+        self.capacity = float('nan')
+        # Replica IDs that have announced themselves and that have finished learning
+        self.ready_replicas = set()
+        self.learned_replicas = set()
+        self.never_ready_replicas = 0
+        self.unresponsive_replicas = ""
+        self.start_received = False
+        self.training_sent = False
+        self.tasks_started = False
+        self.evaluation_started = False
+        # Called with this benchmark when the evaluation is done. If it is not set, the IO loop is stopped.
+        self.on_finished = None
+        self.result_grace_period = RESULT_GRACE_PERIOD_SECONDS
+
+    def parse_parameters(self):
+        """
+        Parse the parameter model and get parameter values.
+        """
         self.parameters_graph = Graph()
         self.parameters_graph.parse(data=self.config["benchmark_parameter_model"], format="json-ld")
         self.dataset_iri = self.parameters_graph.objects(predicate=URIRef(BENCHMARK_NAMESPACE + "dataset")).__next__()
@@ -69,17 +200,45 @@ class AIWinterSchoolBenchmark:
             logger.error(f"Seed parameter is not set.")
             raise AttributeError()
         self.seed = int(seed_str)
+        # Optional parameters
+        self.system_replicas = self.get_optional_parameter("systemReplicas", int, self.system_replicas)
+        self.tasks_in_flight = self.get_optional_parameter("tasksInFlight", int, self.tasks_in_flight)
+        self.replica_timeout_seconds = self.get_optional_parameter("replicaTimeoutSeconds", float,
+                                                                   self.replica_timeout_seconds)
+        if (self.system_replicas < 1 or (self.tasks_in_flight is not None and self.tasks_in_flight < 1)
+                or self.replica_timeout_seconds <= 0):
+            logger.error(f"The number of system replicas, tasks in flight and the replica timeout have to be positive.")
+            raise AttributeError()
+        self.warmup_tasks = self.get_optional_parameter("warmupTasks", int, self.warmup_tasks)
+        self.warmup_seconds = self.get_optional_parameter("warmupSeconds", float, self.warmup_seconds)
+        self.cooldown_tasks = self.get_optional_parameter("cooldownTasks", int, self.cooldown_tasks)
+        if self.warmup_tasks < 0 or self.warmup_seconds < 0 or self.cooldown_tasks < 0:
+            logger.error(f"The warm-up and cooldown parameters must not be negative.")
+            raise AttributeError()
+        self.latency_slo = self.get_optional_parameter("latencySlo", float, self.latency_slo)
+        self.latency_slo_percentile = self.get_optional_parameter("latencySloPercentile", float,
+                                                                  self.latency_slo_percentile)
+        self.capacity_step_seconds = self.get_optional_parameter("capacityStepSeconds", float,
+                                                                 self.capacity_step_seconds)
+        self.capacity_start_rate = self.get_optional_parameter("capacityStartRate", float, self.capacity_start_rate)
+        if ((self.latency_slo is not None and self.latency_slo <= 0) or not 0 < self.latency_slo_percentile <= 100
+                or self.capacity_step_seconds <= 0 or self.capacity_start_rate <= 0):
+            logger.error(f"The capacity search parameters have to be positive.")
+            raise AttributeError()
 
-        self.connection = None
-        self.connection_attempt_counts = 0
-        self.channel = None
-        self.next_task_id = 0
-        self.system_id = None
-        self.test_data = None
-        self.train_data = None
-        self.timestamps_sent = {}
-        self.timestamps_received = {}
-        self.answers = {}
+    def get_optional_parameter(self, name, parse, default):
+        """
+        Get the value of an optional parameter from the parameter model.
+
+        Args:
+            name: The local name of the parameter in the benchmark namespace.
+            parse: The function that converts the RDF literal into the parameter value.
+            default: The value that is returned if the parameter is not set.
+        """
+        value = next(self.parameters_graph.objects(predicate=URIRef(BENCHMARK_NAMESPACE + name)), None)
+        if value is None:
+            return default
+        return parse(value)
 
     def prepare_data(self):
         """
@@ -94,7 +253,7 @@ class AIWinterSchoolBenchmark:
             logger.error(f"Unknown dataset IRI {self.dataset_iri}.")
             raise AttributeError()
         # Load file
-        data = pd.read_csv(data_file, sep=FILE_CSV_SEPARATOR)
+        data = load_dataset(data_file)
         # Init RNG
         rng = np.random.default_rng(seed=self.seed)
         # Split data into train and test data
@@ -104,30 +263,158 @@ class AIWinterSchoolBenchmark:
         # Let them drop indexes; we can use the index of the test data later on as task ID
         self.train_data.reset_index(drop=True, inplace=True)
         self.test_data.reset_index(drop=True, inplace=True)
+        # Encode the tasks in the background, so that the dispatching can start with the first shard
+        thread = Thread(target=self.materialize_tasks, args=[])
+        thread.daemon = True
+        thread.start()
+
+    def materialize_tasks(self):
+        """
+        Encode the test data as task messages. The test data is split into shards that are encoded by a pool of
+        worker processes. The shards are appended to the task messages in the order of the task IDs as soon as they
+        are ready.
+        """
+        try:
+            shards = [self.test_data.iloc[start:start + TASK_SHARD_SIZE]
+                      for start in range(0, len(self.test_data), TASK_SHARD_SIZE)]
+            if len(shards) <= 1:
+                # Starting worker processes isn't worth it for a single shard
+                results = map(encode_task_shard, shards)
+                self.add_task_messages(results)
+            else:
+                logger.info(f"Encoding {len(self.test_data)} tasks in {len(shards)} shards...")
+                # This runs in a background thread while the IO loop and other threads are running. Forking would copy
+                # their locks in whatever state they are. Hence, the workers are started with spawn.
+                with ProcessPoolExecutor(max_workers=min(len(shards), os.cpu_count() or 1),
+                                         mp_context=multiprocessing.get_context("spawn")) as executor:
+                    self.add_task_messages(executor.map(encode_task_shard, shards))
+        except Exception as e:
+            logger.exception(f"Couldn't encode the tasks. They will be encoded one by one while sending: {e}")
+            with self.task_messages_condition:
+                self.task_materialization_failed = True
+                self.task_messages_condition.notify_all()
+
+    def add_task_messages(self, encoded_shards):
+        for messages in encoded_shards:
+            with self.task_messages_condition:
+                self.task_messages.extend(messages)
+                self.task_messages_condition.notify_all()
+
+    def get_task_message(self, task_id):
+        """
+        Get the encoded message of the given task. Waits until the shard of the task has been encoded.
+        """
+        with self.task_messages_condition:
+            self.task_messages_condition.wait_for(
+                lambda: task_id < len(self.task_messages) or self.task_materialization_failed)
+            if task_id < len(self.task_messages):
+                return self.task_messages[task_id]
+        return self.test_data.iloc[[task_id]].to_csv(sep=MESSAGE_CSV_SEPARATOR, header=True)
+
+    def get_ready_task_message(self, task_id):
+        """
+        Get the encoded message of the given task if its shard has already been encoded. Otherwise, None is returned.
+        """
+        with self.task_messages_condition:
+            if task_id < len(self.task_messages):
+                return self.task_messages[task_id]
+        return None
 
     def send_train_data(self):
         logger.info("Sending training data...")
         train_csv = self.train_data.to_csv(sep=MESSAGE_CSV_SEPARATOR)
-        self.channel.basic_publish(exchange='', routing_key=self.config["train_queue_name"], body=train_csv)
+        if self.system_replicas > 1:
+            # Every replica has to be trained
+            self.channel.basic_publish(exchange=self.config["train_exchange_name"], routing_key='', body=train_csv)
+        else:
+            self.channel.basic_publish(exchange='', routing_key=self.config["train_queue_name"], body=train_csv)
+
+    def send_train_data_if_replicas_ready(self):
+        """
+        Send the training data as soon as the benchmark has been started and all replicas have announced themselves.
+        Replicas that are not ready yet would miss the broadcast.
+        """
+        if self.start_received and not self.training_sent and len(self.ready_replicas) >= self.system_replicas:
+            self.training_sent = True
+            self.send_train_data()
+
+    def check_replicas(self):
+        """
+        Called (by the IO loop thread) when the replica timeout expires. If some replicas didn't get ready or didn't
+        finish learning in time, they are reported and the experiment continues with the remaining replicas (or is
+        aborted if there are none).
+        """
+        if self.tasks_started or self.evaluation_started:
+            return
+        if not self.training_sent:
+            self.never_ready_replicas = max(0, self.system_replicas - len(self.ready_replicas))
+        unresponsive = sorted(self.ready_replicas - self.learned_replicas) if self.training_sent else []
+        if self.never_ready_replicas > 0:
+            unresponsive.append(f"{self.never_ready_replicas} never ready")
+        self.unresponsive_replicas = ", ".join(unresponsive)
+        logger.error(f"Replicas didn't respond within {self.replica_timeout_seconds} s: {self.unresponsive_replicas} "
+                     f"(ready: {sorted(self.ready_replicas)}, finished learning: {sorted(self.learned_replicas)}).")
+        if not self.training_sent and len(self.ready_replicas) > 0:
+            # Continue with the replicas that are ready and give them time to learn
+            self.system_replicas = len(self.ready_replicas)
+            self.send_train_data_if_replicas_ready()
+            self.connection.ioloop.call_later(self.replica_timeout_seconds, self.check_replicas)
+        elif len(self.learned_replicas) > 0:
+            self.system_replicas = len(self.learned_replicas)
+            self.start_tasks()
+        else:
+            logger.error("No replica is available. Aborting the experiment.")
+            self.evaluation_started = True
+            thread = Thread(target=self.run_evaluation, args=[])
+            thread.start()
+
+    def start_tasks(self):
+        """
+        Start sending tasks after the system has been trained (or the capacity search, if a latency SLO is given).
+        """
+        self.tasks_started = True
+        if self.latency_slo is not None:
+            thread = Thread(target=self.run_capacity_search, args=[])
+            thread.start()
+        else:
+            self.start_sending_tasks()
+
+    def start_sending_tasks(self):
+        """
+        Fill the window of tasks that are sent without waiting for an answer. Afterwards, every answer triggers the
+        next task.
+        """
+        tasks_in_flight = self.tasks_in_flight if self.tasks_in_flight is not None else self.system_replicas
+        for x in range(tasks_in_flight):
+            self.send_next_task()
 
     def run_evaluation(self):
         self.send_command(TASK_GENERATION_FINISHED_SIGNAL)
         logger.info("Starting evaluation...")
-        self.evaluate()
+        if self.latency_slo is not None:
+            self.evaluate_capacity()
+        else:
+            self.evaluate()
         logger.info("Everything is done.")
-        self.connection.ioloop.stop()
+        if self.on_finished is not None:
+            self.on_finished(self)
+        else:
+            self.connection.ioloop.stop()
 
-    def send_task(self):
+    def send_task(self, task_id, task_csv):
         """
-        Sends a task to the task queue.
+        Sends a task to the task queue (has to be called by the IO loop thread, since channels are not thread safe).
         """
         task_queue = self.config["task_queue_name"]
-        task_csv = self.test_data.iloc[[self.next_task_id]].to_csv(sep=MESSAGE_CSV_SEPARATOR, header=True)
-        self.channel.basic_publish(exchange='', routing_key=task_queue, body=task_csv)
         # Add the time stamp at which we sent the data
-        self.timestamps_sent[self.next_task_id] = time.time_ns()
-        logger.info(f"Sent task #{self.next_task_id} at {self.timestamps_sent[self.next_task_id]}")
-        self.next_task_id += 1
+        self.timestamps_sent[task_id] = time.time_ns()
+        self.channel.basic_publish(exchange='', routing_key=task_queue, body=task_csv)
+        logger.info(f"Sent task #{task_id} at {self.timestamps_sent[task_id]}")
+
+    def wait_and_send_task(self, task_id):
+        # Wait for the shard of the task without blocking the IO loop and hand the message over to it afterwards
+        task_csv = self.get_task_message(task_id)
+        self.connection.ioloop.add_callback_threadsafe(functools.partial(self.send_task, task_id, task_csv))
 
     def evaluate(self):
         """
@@ -136,24 +423,43 @@ class AIWinterSchoolBenchmark:
         expected_result_column = len(self.test_data.columns) - 1
         error_count = 0
         runtimes = []
+        warmup_runtimes = []
+        warmup_count = 0
+        cooldown_count = 0
+        steady_task_ids = []
+        # Runtimes per system replica (the replica ID is the optional third value of an answer)
+        replica_runtimes = {}
+        start_time = min(self.timestamps_sent.values()) if len(self.timestamps_sent) > 0 else 0
         for i in range(len(self.test_data)):
-            answer_data = self.answers[i]
-            received_at = self.timestamps_received[i]
+            phase = self.get_phase(i, start_time)
+            if phase == WARMUP_PHASE:
+                warmup_count += 1
+            elif phase == COOLDOWN_PHASE:
+                cooldown_count += 1
+            answer_data = self.answers.get(i)
+            received_at = self.timestamps_received.get(i)
             if answer_data is not None and received_at is not None:
                 # Compare answer_data with the expected answer
                 # expected answer: test_data.iloc[i, expected_result_column]
                 # prediction of the system: answer_data.iloc[0, 1]
                 print(f"expected: {self.test_data.iloc[i, expected_result_column]} predicted: {answer_data.iloc[0, 1]}")
 
-                runtimes.append((received_at - self.timestamps_sent[i]) / 1000.0)
+                runtime = (received_at - self.timestamps_sent[i]) / 1000.0
+                if phase == WARMUP_PHASE:
+                    warmup_runtimes.append(runtime)
+                elif phase == STEADY_STATE_PHASE:
+                    runtimes.append(runtime)
+                    steady_task_ids.append(i)
+                    replica_id = str(answer_data.iloc[0, 2]) if len(answer_data.columns) > 2 else "unknown"
+                    replica_runtimes.setdefault(replica_id, []).append(runtime)
             else:
-                ++error_count
+                error_count += 1
 
         # Determine the KPIs we are interested in
         results = []
         # Here, it would be good to measure some quality...
 
-        # Average runtime and its standard deviation
+        # Average runtime and its standard deviation (steady state only)
         runtime_avg = float('nan')
         runtime_std_dev = float('nan')
         logger.info(f"timestamps: {runtimes}")
@@ -169,10 +475,276 @@ class AIWinterSchoolBenchmark:
                                        value=len(self.test_data), data_type="xsd:long"))
         results.append(BenchmarkResult(kpi_iri=BENCHMARK_NAMESPACE+"faultyResponses",
                                        value=error_count, data_type="xsd:long"))
+        # Warm-up and cooldown
+        warmup_runtime_avg = float('nan')
+        if len(warmup_runtimes) > 0:
+            warmup_runtime_avg = sum(warmup_runtimes) / len(warmup_runtimes)
+        results.append(BenchmarkResult(kpi_iri=BENCHMARK_NAMESPACE + "avgWarmupRuntime",
+                                       value=warmup_runtime_avg, data_type="xsd:double"))
+        results.append(BenchmarkResult(kpi_iri=BENCHMARK_NAMESPACE + "warmupTaskCount",
+                                       value=warmup_count, data_type="xsd:long"))
+        results.append(BenchmarkResult(kpi_iri=BENCHMARK_NAMESPACE + "cooldownTaskCount",
+                                       value=cooldown_count, data_type="xsd:long"))
+        results.extend(self.evaluate_replicas(replica_runtimes, steady_task_ids))
 
         # Send an RDF model with the results to the platform
         self.send_result(results)
 
+    def run_capacity_search(self):
+        """
+        Search the highest rate at which the system can be driven without violating the latency SLO. The rate is
+        doubled (or halved) until the SLO is violated (or met) and the resulting interval is bisected afterwards.
+        The search stops early if the benchmark itself can't send at the offered rate. Finally, the evaluation is
+        started (even if the search failed, with the steps measured so far).
+        """
+        logger.info(f"Starting capacity search with a latency SLO of {self.latency_slo} ms "
+                    f"(p{self.latency_slo_percentile})...")
+        self.capacity = 0.0
+        self.capacity_search_running = True
+        try:
+            # Bracket the capacity
+            unsustainable_rate = None
+            rate = self.capacity_start_rate
+            sender_limited = False
+            while len(self.capacity_steps) < CAPACITY_SEARCH_MAX_STEPS:
+                sustainable = self.run_load_step(rate)
+                if sustainable is None:
+                    sender_limited = True
+                    break
+                if sustainable:
+                    self.capacity = rate
+                    if unsustainable_rate is not None:
+                        break
+                    rate *= 2
+                else:
+                    unsustainable_rate = rate
+                    if self.capacity > 0:
+                        break
+                    rate /= 2
+            # Bisect the interval
+            while (not sender_limited and unsustainable_rate is not None and self.capacity > 0
+                   and unsustainable_rate - self.capacity > CAPACITY_SEARCH_PRECISION * self.capacity
+                   and len(self.capacity_steps) < CAPACITY_SEARCH_MAX_STEPS):
+                rate = (self.capacity + unsustainable_rate) / 2
+                sustainable = self.run_load_step(rate)
+                if sustainable is None:
+                    sender_limited = True
+                elif sustainable:
+                    self.capacity = rate
+                else:
+                    unsustainable_rate = rate
+            if sender_limited:
+                logger.warning(f"The benchmark couldn't send tasks at {rate:.3f} tasks/s. The maximum sustainable "
+                               f"rate is only a lower bound.")
+            logger.info(f"Maximum sustainable rate: {self.capacity} tasks/s")
+        except Exception as e:
+            logger.exception(f"Capacity search failed. Reporting the steps measured so far: {e}")
+        finally:
+            self.capacity_search_running = False
+        self.run_evaluation()
+
+    def wait_for_capacity_answers(self):
+        """
+        Wait until all tasks sent during the capacity search have been answered.
+
+        Returns:
+            bool: False if the answers didn't arrive within the drain timeout
+        """
+        deadline = time.time() + max(CAPACITY_SEARCH_DRAIN_TIMEOUT_SECONDS, 2 * self.capacity_step_seconds)
+        pending = set(self.capacity_timestamps_sent.keys())
+        while True:
+            pending = {i for i in pending if i not in self.capacity_timestamps_received}
+            if len(pending) == 0:
+                return True
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.01)
+
+    def run_load_step(self, rate):
+        """
+        Send tasks at the given rate for the configured step duration (cycling through the test data) and check
+        whether the latencies meet the SLO. A step only starts after all tasks of the previous steps have been
+        answered, so that it doesn't measure their backlog.
+
+        Args:
+            rate: The offered load in tasks per second.
+
+        Returns:
+            bool: True if the SLO is met, i.e., the system can sustain the given rate, or None if the step is invalid
+                since the tasks couldn't be sent on schedule
+        """
+        if not self.wait_for_capacity_answers():
+            raise Exception("The system didn't answer the tasks of the previous capacity search step in time.")
+        task_count = max(1, int(rate * self.capacity_step_seconds))
+        first_task_id = len(self.capacity_timestamps_sent)
+        task_ids = range(first_task_id, first_task_id + task_count)
+        logger.info(f"Capacity search step #{len(self.capacity_steps)}: {task_count} tasks at {rate:.3f} tasks/s...")
+        start = time.time_ns()
+        for i, task_id in enumerate(task_ids):
+            # Open loop: the tasks are sent according to the schedule, independent of the answers. The latency is
+            # measured from the scheduled time, so that delays of the sending are not hidden.
+            scheduled_at = start + int(i * 1e9 / rate)
+            delay = (scheduled_at - time.time_ns()) / 1e9
+            if delay > 0:
+                time.sleep(delay)
+            message = self.get_task_message(task_id % len(self.test_data))
+            # Replace the ID of the test instance by the unique ID of this task
+            header_end = message.index("\n") + 1
+            message = (message[:header_end] + str(task_id)
+                       + message[message.index(MESSAGE_CSV_SEPARATOR, header_end):])
+            self.capacity_timestamps_sent[task_id] = scheduled_at
+            # Channels are not thread safe. Hence, the IO loop thread has to send the message.
+            self.connection.ioloop.add_callback_threadsafe(functools.partial(self.send_capacity_task, task_id, message))
+        # Wait for the answers. If they don't arrive in time, the step can't be measured and counts as violation.
+        if not self.wait_for_capacity_answers():
+            lost = sum(1 for i in task_ids if i not in self.capacity_timestamps_received)
+            self.capacity_steps.append({
+                "rate": rate,
+                "achieved_rate": float('nan'),
+                "p50": float('nan'),
+                "percentile": float('nan'),
+                "lost": lost,
+                "sender_lag": float('nan'),
+                "sustainable": False
+            })
+            logger.info(f"Capacity search step timed out with {lost} unanswered tasks.")
+            return False
+
+        # The latency is measured from the scheduled time. If the benchmark itself lags behind the schedule, it
+        # doesn't offer the given rate and the delay would be counted as latency of the system. Like the latency, the
+        # lag is judged by the SLO percentile.
+        sender_lags = np.array([(self.capacity_timestamps_published[i] - self.capacity_timestamps_sent[i]) / 1e6
+                                for i in task_ids])
+        sender_lag = float(np.percentile(sender_lags, self.latency_slo_percentile, method='higher'))
+        if sender_lag > CAPACITY_SEARCH_MAX_SENDER_LAG * self.latency_slo:
+            self.capacity_steps.append({
+                "rate": rate,
+                "achieved_rate": float('nan'),
+                "p50": float('nan'),
+                "percentile": float('nan'),
+                "lost": 0,
+                "sender_lag": sender_lag,
+                "sustainable": None
+            })
+            logger.warning(f"Capacity search step is invalid: the p{self.latency_slo_percentile:g} of the delay of "
+                           f"the sending is {sender_lag:.3f} ms.")
+            return None
+
+        latencies = np.array([(self.capacity_timestamps_received[i] - self.capacity_timestamps_sent[i]) / 1e6
+                              for i in task_ids])
+        latency_percentile = float(np.percentile(latencies, self.latency_slo_percentile, method='higher'))
+        achieved_rate = float('nan')
+        if task_count > 1:
+            achieved_rate = task_count / ((max(self.capacity_timestamps_received[i] for i in task_ids)
+                                           - self.capacity_timestamps_sent[first_task_id]) / 1e9)
+        sustainable = latency_percentile <= self.latency_slo
+        self.capacity_steps.append({
+            "rate": rate,
+            "achieved_rate": achieved_rate,
+            "p50": float(np.percentile(latencies, 50, method='higher')),
+            "percentile": latency_percentile,
+            "lost": 0,
+            "sender_lag": sender_lag,
+            "sustainable": sustainable
+        })
+        logger.info(f"Capacity search step result: {self.capacity_steps[-1]}")
+        return sustainable
+
+    def send_capacity_task(self, task_id, message):
+        self.capacity_timestamps_published[task_id] = time.time_ns()
+        self.channel.basic_publish(exchange='', routing_key=self.config["task_queue_name"], body=message)
+
+    def evaluate_capacity(self):
+        """
+        Report the result of the capacity search.
+        """
+        results = []
+        results.append(BenchmarkResult(kpi_iri=BENCHMARK_NAMESPACE + "maxSustainableRate",
+                                       value=self.capacity, data_type="xsd:double"))
+        # The latency curve: offered rate, achieved rate, median and SLO percentile latency of every load step
+        curve = []
+        for step in sorted(self.capacity_steps, key=lambda x: x["rate"]):
+            if step["lost"] > 0:
+                curve.append(f"{step['rate']:.3f} tasks/s: timed out, {step['lost']} lost")
+            elif step["sustainable"] is None:
+                curve.append(f"{step['rate']:.3f} tasks/s: invalid, sender lag {step['sender_lag']:.3f} ms")
+            else:
+                curve.append(f"{step['rate']:.3f} tasks/s: achieved {step['achieved_rate']:.3f} tasks/s, "
+                             f"p50 {step['p50']:.3f} ms, p{self.latency_slo_percentile:g} {step['percentile']:.3f} ms, "
+                             f"sender lag {step['sender_lag']:.3f} ms")
+        results.append(BenchmarkResult(kpi_iri=BENCHMARK_NAMESPACE + "capacityLatencyCurve",
+                                       value=" | ".join(curve), data_type="xsd:string"))
+        results.append(BenchmarkResult(kpi_iri=BENCHMARK_NAMESPACE + "capacitySearchSteps",
+                                       value=len(self.capacity_steps), data_type="xsd:long"))
+        results.append(BenchmarkResult(kpi_iri=BENCHMARK_NAMESPACE + "unresponsiveReplicas",
+                                       value=self.unresponsive_replicas, data_type="xsd:string"))
+        results.append(BenchmarkResult(kpi_iri=BENCHMARK_NAMESPACE + "testDataSize",
+                                       value=len(self.test_data), data_type="xsd:long"))
+        self.send_result(results)
+
+    def get_phase(self, task_id, start_time):
+        """
+        Determine whether the given task belongs to the warm-up, the steady state or the cooldown of the test.
+
+        Args:
+            task_id: The ID of the task. Tasks are sent in the order of their IDs.
+            start_time: The time stamp (in ns) at which the first task has been sent.
+        """
+        if task_id < self.warmup_tasks:
+            return WARMUP_PHASE
+        sent_at = self.timestamps_sent.get(task_id)
+        if sent_at is not None and (sent_at - start_time) < self.warmup_seconds * 1e9:
+            return WARMUP_PHASE
+        if task_id >= len(self.test_data) - self.cooldown_tasks:
+            return COOLDOWN_PHASE
+        return STEADY_STATE_PHASE
+
+    def evaluate_replicas(self, replica_runtimes, task_ids):
+        """
+        Determine the throughput of the whole system and of its single replicas as well as the load imbalance between
+        the replicas.
+
+        Args:
+            replica_runtimes (dict): The runtimes of the answered tasks per replica ID
+            task_ids (list): The IDs of the answered tasks that the throughput is based on
+
+        Returns:
+            list: The BenchmarkResult instances of the KPIs
+        """
+        results = []
+        # The duration from sending the first of the given tasks until the last answer in seconds
+        duration = float('nan')
+        if len(task_ids) > 0:
+            duration = (max(self.timestamps_received[i] for i in task_ids)
+                        - min(self.timestamps_sent[i] for i in task_ids)) / 1e9
+        answered = sum(len(x) for x in replica_runtimes.values())
+        throughput = answered / duration if duration > 0 else float('nan')
+        results.append(BenchmarkResult(kpi_iri=BENCHMARK_NAMESPACE + "throughput",
+                                       value=throughput, data_type="xsd:double"))
+        results.append(BenchmarkResult(kpi_iri=BENCHMARK_NAMESPACE + "replicaCount",
+                                       value=len(replica_runtimes), data_type="xsd:long"))
+        # Load imbalance: the number of tasks of the busiest replica divided by the average number of tasks per
+        # replica (1.0 means that the load is perfectly balanced)
+        imbalance = float('nan')
+        if len(replica_runtimes) > 0:
+            task_counts = [len(x) for x in replica_runtimes.values()]
+            imbalance = max(task_counts) / (sum(task_counts) / len(task_counts))
+        results.append(BenchmarkResult(kpi_iri=BENCHMARK_NAMESPACE + "loadImbalance",
+                                       value=imbalance, data_type="xsd:double"))
+        # Statistics of the single replicas as a human-readable string
+        replica_stats = []
+        for replica_id in sorted(replica_runtimes.keys()):
+            runtimes = replica_runtimes[replica_id]
+            replica_throughput = len(runtimes) / duration if duration > 0 else float('nan')
+            replica_stats.append(f"{replica_id}: {len(runtimes)} tasks, {replica_throughput:.3f} tasks/s, "
+                                 f"avg runtime {sum(runtimes) / len(runtimes):.3f}")
+        logger.info(f"Replica statistics: {replica_stats}")
+        results.append(BenchmarkResult(kpi_iri=BENCHMARK_NAMESPACE + "replicaStatistics",
+                                       value=" | ".join(replica_stats), data_type="xsd:string"))
+        results.append(BenchmarkResult(kpi_iri=BENCHMARK_NAMESPACE + "unresponsiveReplicas",
+                                       value=self.unresponsive_replicas, data_type="xsd:string"))
+        return results
+
     # ************************************************************************************************************
     # *** From here on, the implementation focuses on the setup of the communication and the general workflow. ***
     # *** It might not be too interesting for the beginning.                                                   ***
@@ -200,18 +772,24 @@ class AIWinterSchoolBenchmark:
         logger.info("Sending result model: " + result_model)
         self.send_command(BENCHMARK_FINISHED_SIGNAL, result_model)
         # It seems like we shouldn't quit too fast. Otherwise, the platform may think that the benchmark crashed.
-        # Let's wait for 20 seconds...
-        time.sleep(20)
+        # Let's wait for a few seconds...
+        time.sleep(self.result_grace_period)
 
     def send_next_task(self):
         if self.next_task_id < len(self.test_data):
             logger.info(f"Sending task # {self.next_task_id}...")
-            # TODO This is costly. We should use a thread pool.
-            thread = Thread(target=self.send_task, args=[])
-            thread.start()
-            # self.send_task()
-        else:
+            # Reserve the task ID here, since several tasks may be sent at the same time
+            task_id = self.next_task_id
+            self.next_task_id += 1
+            task_csv = self.get_ready_task_message(task_id)
+            if task_csv is not None:
+                self.send_task(task_id, task_csv)
+            else:
+                thread = Thread(target=self.wait_and_send_task, args=[task_id])
+                thread.start()
+        elif self.answers_received >= len(self.test_data) and not self.evaluation_started:
             logger.info("All tasks generated.")
+            self.evaluation_started = True
             # TODO This is costly. We should use a thread pool.
             thread = Thread(target=self.run_evaluation, args=[])
             thread.start()
@@ -232,8 +810,10 @@ class AIWinterSchoolBenchmark:
             if data is not None:
                 content += data.encode('utf-8')
 
-            # Publish the message to the specified exchange
-            self.channel.basic_publish(exchange='hobbit.command', routing_key='', body=content)
+            # Publish the message to the specified exchange. Channels are not thread safe. Hence, the IO loop thread
+            # has to send the message.
+            self.connection.ioloop.add_callback_threadsafe(
+                functools.partial(self.channel.basic_publish, exchange='hobbit.command', routing_key='', body=content))
             logger.info(f"Sent {content}")
         except Exception as e:
             logger.exception(f"Error sending command: {e}")
@@ -304,6 +884,7 @@ class AIWinterSchoolBenchmark:
         self.channel.queue_declare(queue='', exclusive=True, callback=call_step2)
 
     def declare_queues_step2(self, command_queue_name):
+        self.command_queue_name = command_queue_name
         # Define handler for commands
         def handle_command(ch, method, properties, body):
             try:
@@ -330,11 +911,31 @@ class AIWinterSchoolBenchmark:
                 if command_id == START_BENCHMARK_SIGNAL:
                     logger.info(f"Received START_BENCHMARK_SIGNAL command for session: {session_id}")
                     self.system_id = body[id_end_pos + 1:].decode("utf-8")
-                    # We should start the benchmarking process by sending the first task
-                    self.send_train_data()
+                    self.start_received = True
+                    # We should start the benchmarking process by sending the training data
+                    if self.system_replicas > 1:
+                        # ...as soon as all replicas are ready
+                        self.connection.ioloop.call_later(self.replica_timeout_seconds, self.check_replicas)
+                        self.send_train_data_if_replicas_ready()
+                    else:
+                        self.training_sent = True
+                        self.send_train_data()
+                elif command_id == REPLICA_READY_SIGNAL:
+                    replica_id = body[id_end_pos + 1:].decode("utf-8")
+                    if replica_id not in self.ready_replicas:
+                        self.ready_replicas.add(replica_id)
+                        logger.info(f"Replica {replica_id} is ready "
+                                    f"({len(self.ready_replicas)}/{self.system_replicas}).")
+                    self.send_train_data_if_replicas_ready()
                 elif command_id == LEARNING_FINISHED_SIGNAL:
-                    # The system is trained. We should send the first task
-                    self.send_next_task()
+                    replica_id = body[id_end_pos + 1:].decode("utf-8")
+                    # Systems that don't send their ID are counted as separate replicas
+                    self.learned_replicas.add(replica_id if len(replica_id) > 0 else f"#{len(self.learned_replicas)}")
+                    logger.info(f"Replica {replica_id} finished learning "
+                                f"({len(self.learned_replicas)}/{self.system_replicas}).")
+                    # If all replicas are trained, we should send the first tasks
+                    if len(self.learned_replicas) >= self.system_replicas and not self.tasks_started:
+                        self.start_tasks()
                 else:
                     print(f"Received unknown command: {command_id}")
             except Exception as e:
@@ -363,6 +964,16 @@ class AIWinterSchoolBenchmark:
         def handle_data(ch, method, header, body):
             # First, get the current time
             timestamp_received = time.time_ns()
+            if self.latency_slo is not None:
+                # The capacity search only needs the task ID and sends the tasks on its own. Answers arriving after
+                # the search are dropped.
+                if self.capacity_search_running:
+                    try:
+                        task_id = int(body.decode("utf-8").split(MESSAGE_CSV_SEPARATOR, 1)[0])
+                        self.capacity_timestamps_received[task_id] = timestamp_received
+                    except Exception as e:
+                        logging.exception(f"An error occurred while parsing answer: {e}")
+                return
             # Try to parse the answer
             try:
                 # Parse the answer as CSV
@@ -375,6 +986,7 @@ class AIWinterSchoolBenchmark:
                 logger.info(f"Received an answer for #{task_id} at {timestamp_received}...")
             except Exception as e:
                 logging.exception(f"An error occurred while parsing answer: {e}")
+            self.answers_received += 1
             # Send next task
             self.send_next_task()
 
@@ -387,6 +999,14 @@ class AIWinterSchoolBenchmark:
         self.channel.queue_declare(queue=self.config["train_queue_name"], auto_delete=True, callback=call_step5)
 
     def declare_queues_step5(self):
+        def call_step6(frame):
+            self.declare_queues_step6()
+
+        # Declare the exchange that broadcasts the training data to several system replicas
+        self.channel.exchange_declare(exchange=self.config["train_exchange_name"], exchange_type='fanout',
+                                      auto_delete=True, callback=call_step6)
+
+    def declare_queues_step6(self):
         # Send a signal that the benchmark is ready to start
         logger.info("Setup done. Sending ready signal...")
         self.send_command(BENCHMARK_READY_SIGNAL)
@@ -418,6 +1038,154 @@ class AIWinterSchoolBenchmark:
                 pass  # nothing to do
 
 
+class AIWinterSchoolBenchmarkSweep:
+    """
+    Runs several experiments over a single RabbitMQ connection. Every experiment has its own session ID and, hence,
+    its own channel and queues. Each experiment sends its own result model. Datasets are loaded only once.
+    """
+
+    def __init__(self, experiments: list, concurrency: int = 1):
+        """
+        Args:
+            experiments (list): The experiments as dictionaries with the keys session_id, experiment_uri, dataset
+                (the IRI or the local name of the dataset), seed and, optionally, system_replicas,
+                replica_timeout_seconds, tasks_in_flight, warmup_tasks, warmup_seconds, cooldown_tasks, latency_slo,
+                latency_slo_percentile, capacity_step_seconds and capacity_start_rate
+            concurrency (int): The number of experiments that are executed at the same time
+        """
+        self.config = {
+            "rabbitmq_host": os.getenv("HOBBIT_RABBIT_HOST", "127.0.0.1"),
+        }
+        self.concurrency = max(1, concurrency)
+        self.benchmarks = []
+        for experiment in experiments:
+            dataset_iri = experiment["dataset"]
+            if not dataset_iri.startswith("http"):
+                dataset_iri = BENCHMARK_NAMESPACE + dataset_iri
+            benchmark = AIWinterSchoolBenchmark(session_id=experiment["session_id"],
+                                                experiment_uri=experiment.get("experiment_uri", ""),
+                                                dataset_iri=dataset_iri, seed=experiment["seed"])
+            benchmark.system_replicas = int(experiment.get("system_replicas", 1))
+            benchmark.replica_timeout_seconds = float(experiment.get("replica_timeout_seconds", 600.0))
+            if "tasks_in_flight" in experiment:
+                benchmark.tasks_in_flight = int(experiment["tasks_in_flight"])
+            benchmark.warmup_tasks = int(experiment.get("warmup_tasks", 0))
+            benchmark.warmup_seconds = float(experiment.get("warmup_seconds", 0.0))
+            benchmark.cooldown_tasks = int(experiment.get("cooldown_tasks", 0))
+            if "latency_slo" in experiment:
+                benchmark.latency_slo = float(experiment["latency_slo"])
+            benchmark.latency_slo_percentile = float(experiment.get("latency_slo_percentile", 99.0))
+            benchmark.capacity_step_seconds = float(experiment.get("capacity_step_seconds", 10.0))
+            benchmark.capacity_start_rate = float(experiment.get("capacity_start_rate", 10.0))
+            benchmark.on_finished = self.on_benchmark_finished
+            # The sweep waits only once at the very end
+            benchmark.result_grace_period = 0
+            self.benchmarks.append(benchmark)
+        self.pending = list(self.benchmarks)
+        self.running = 0
+        self.connection = None
+        self.connection_attempt_counts = 0
+
+    def setup_connection(self):
+        """
+        Set up the connection to RabbitMQ that is shared by all experiments.
+        """
+
+        def on_connected(new_connection):
+            """Called when we are fully connected to RabbitMQ"""
+            logger.info("Got a new connection.")
+            self.connection = new_connection
+            for x in range(self.concurrency):
+                self.start_next_benchmark()
+
+        def on_connection_error(new_connection, exception):
+            """Called when we couldn't connect to RabbitMQ"""
+            if self.connection_attempt_counts < MAX_CONNECTION_ATTEMPTS:
+                logger.info("Got an error while waiting for the connection. Trying it again...")
+                self.connection_attempt_counts += 1
+                time.sleep(SECONDS_BETWEEN_CONNECTION_ATTEMPTS)
+                self.connection = pika.SelectConnection(
+                    parameters=pika.ConnectionParameters(self.config["rabbitmq_host"]),
+                    on_open_callback=on_connected,
+                    on_close_callback=stop_looping_on_close,
+                    on_open_error_callback=on_connection_error
+                )
+            else:
+                logger.exception(exception)
+                new_connection.ioloop.stop()
+
+        logger.info("Trying to connect to " + self.config["rabbitmq_host"] + "...")
+        self.connection_attempt_counts += 1
+        self.connection = pika.SelectConnection(parameters=pika.ConnectionParameters(self.config["rabbitmq_host"]),
+                                                on_open_callback=on_connected,
+                                                on_close_callback=stop_looping_on_close,
+                                                on_open_error_callback=on_connection_error
+                                                )
+
+    def start_next_benchmark(self):
+        """
+        Start the next pending experiment on the shared connection (has to be called by the IO loop thread).
+        """
+        while len(self.pending) > 0:
+            benchmark = self.pending.pop(0)
+            logger.info(f"Starting experiment of session {benchmark.session_id}...")
+            try:
+                # The data is only split when the experiment starts, so that only the running experiments hold their
+                # test data and task messages. The dataset file itself is loaded only once.
+                benchmark.prepare_data()
+            except Exception as e:
+                logging.exception(f"Couldn't prepare the experiment of session {benchmark.session_id}. Skipping it: {e}")
+                self.benchmarks.remove(benchmark)
+                continue
+            self.running += 1
+            benchmark.connection = self.connection
+            benchmark.setup_channel()
+            return
+        if self.running == 0:
+            self.stop_after_grace_period()
+
+    def on_benchmark_finished(self, benchmark):
+        # This is called by the evaluation thread. Hand it over to the IO loop thread.
+        self.connection.ioloop.add_callback_threadsafe(lambda: self.handle_benchmark_finished(benchmark))
+
+    def handle_benchmark_finished(self, benchmark):
+        logger.info(f"Experiment of session {benchmark.session_id} finished.")
+        # The exclusive command queue lives as long as the shared connection. Delete it, so that it doesn't keep
+        # collecting the commands of the following experiments.
+        benchmark.channel.queue_delete(queue=benchmark.command_queue_name,
+                                       callback=lambda frame: benchmark.channel.close())
+        # Free the data of the finished experiment
+        self.benchmarks.remove(benchmark)
+        self.running -= 1
+        if len(self.pending) > 0:
+            self.start_next_benchmark()
+        elif self.running == 0:
+            self.stop_after_grace_period()
+
+    def stop_after_grace_period(self):
+        logger.info("All experiments are done.")
+        # Give the platform some time to receive the results before we stop
+        self.connection.ioloop.call_later(RESULT_GRACE_PERIOD_SECONDS, self.connection.ioloop.stop)
+
+    def run(self):
+        try:
+            self.setup_connection()
+            logger.info("Main thread starting IO loop...")
+            self.connection.ioloop.start()
+            logger.info("Exiting...")
+        except pika.exceptions.AMQPConnectionError as e:
+            logger.error("Failed to connect to RabbitMQ: %s", e)
+        except Exception as e:
+            logging.exception(f"An error occurred: {e}")
+        finally:
+            try:
+                # Try to close the connection
+                if self.connection is not None:
+                    self.connection.close()
+            except Exception as e:
+                pass  # nothing to do
+
+
 def stop_looping_on_close(connection, exception):
     # Invoked when the connection is closed
     connection.ioloop.stop()
@@ -431,7 +1199,12 @@ def main():
     processes incoming tasks, and waits for the TASK_GENERATION_FINISHED
     signal before exiting.
     """
-    benchmark = AIWinterSchoolBenchmark()
+    # A sweep can be defined as JSON list of experiments. Otherwise, we run the single experiment of the platform.
+    sweep = os.getenv("BENCHMARK_SWEEP", "")
+    if len(sweep) > 0:
+        benchmark = AIWinterSchoolBenchmarkSweep(json.loads(sweep), int(os.getenv("BENCHMARK_SWEEP_CONCURRENCY", "1")))
+    else:
+        benchmark = AIWinterSchoolBenchmark()
     benchmark.run()
 
 